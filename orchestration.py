@@ -3,153 +3,329 @@ This script loads configuration settings from a config file and uses them to ini
 group scan, deploy patches, and shut down machines.
 """
 
+import asyncio
 import socket
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import configparser
+from requests.auth import AuthBase
 from requests_kerberos import HTTPKerberosAuth, OPTIONAL
-import json
 import logging
+import logging.handlers
+import queue
+import threading
+import atexit
 import os
 import datetime
+import random
+import urllib.parse
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+# orjson is considerably faster for the small documents of the polling loops, but it is optional
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+# ijson allows listings to be decoded item by item while they are downloaded, but it is optional
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Default headers of the sessions, all request bodies are JSON
+JSON_HEADERS = {'Content-Type': 'application/json'}
+# Statuses of an operation that will never turn into a success anymore
+FAILED_STATUSES = frozenset({"Failed", "FailedToStart", "Cancelled", "Stopped"})
+
+# The (connect, read) timeout in seconds of every HTTP request, so a stalled request raises instead of
+# blocking its worker thread forever
+HTTP_TIMEOUT = (10, 60)
+
+# The maximum number of `shutdown` processes that run at the same time for one ring
+MAX_SHUTDOWN_PROCESSES = 32
+
+
+class ThreadLocalKerberosAuth(AuthBase):
+    """
+    The class gives every thread its own `HTTPKerberosAuth`. `HTTPKerberosAuth` keeps one security
+    context per host and replaces it on every negotiation, so a single instance shared by the worker
+    threads could verify a response against the context of another thread.
+    
+    :param kwargs: The keyword arguments passed to every `HTTPKerberosAuth`
+    """
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.local = threading.local()
 
-
-# These lines are initializing global variables to be used throughout the script. They are all set to
-# `None` initially and will be assigned values later in the `load_config()` function.
-# global variables
-server = None
-first_ring_id = None
-second_ring_id = None
-auth = None
-verify = None
-run_as_credentials = None
-scan_template = None
-machine_group_server = None
-machine_group_database = None
-deployment_template = None
-vcenter_server = None
-vcenter_username = None
-vcenter_password = None
+    def __call__(self, request):
+        auth = getattr(self.local, 'auth', None)
+        if auth is None:
+            auth = self.local.auth = HTTPKerberosAuth(**self.kwargs)
+        return auth(request)
 
 
-def load_config():
+@dataclass(slots=True, frozen=True)
+class Config:
+    """
+    This class holds the configuration settings loaded from the config file. It is created once by
+    `load_config()` and passed explicitly to every function that talks to the iSEC or vCenter server.
+    The `session` is shared by all iSEC API calls so that connections and the Kerberos context are
+    reused instead of being negotiated again for every request.
+    """
+    server: str
+    api_base: str
+    operations_url: str
+    session: requests.Session
+    run_as_credentials: str
+    scan_template: str
+    deployment_template: str
+    machine_group_server: str
+    machine_group_database: str
+    vcenter_server: str
+    vcenter_username: str
+    vcenter_password: str
+
+
+# The last loaded `Config` together with the absolute path and the modification time of the config
+# file it was read from
+_config_cache = None
+
+
+def load_config(path='config.ini'):
     """
-    This function loads configuration settings from a config file and sets them as global variables.
+    This function loads configuration settings from a config file and returns them as a `Config`. The
+    result is cached and the file is only parsed again once its path or modification time changes.
+    Logging is initialized on the first load only.
+    
+    :param path: The path of the config file, defaults to 'config.ini' (optional)
+    :return: a `Config` instance holding the settings of the config file.
     """
-    # define variables as global
-    global server, first_ring_id, second_ring_id, auth, verify, run_as_credentials, scan_template, machine_group_database, machine_group_server, deployment_template, vcenter_password, vcenter_server, vcenter_username
+    global _config_cache
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+    if _config_cache is not None and _config_cache[0] == key:
+        return _config_cache[1]
+
     # Create a ConfigParser object
     config = configparser.ConfigParser()
     # Read the config file
-    config.read('config.ini')
+    config.read(path)
+    # Dump all sections into plain dictionaries once, so the values below are simple dict lookups. The
+    # Logging section is read raw, so a path with a bare `%` (e.g. `%ProgramData%`) does not raise an
+    # error. All other values keep the interpolation, so an escaped `%%` is still read as `%`.
+    sections = {section: dict(config.items(section, raw=(section == 'Logging')))
+                for section in config.sections()}
+
+    if _config_cache is None:
+        init_logging(sections['Logging']['logpath'], sections['Logging']['loglevel'])
+
+    # One session with a connection pool for all iSEC API calls
+    session = requests.Session()
+    # Idempotent requests are retried with backoff on gateway errors. The last response is returned
+    # instead of raising, so the polling loops keep going until their own deadline.
+    retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504], raise_on_status=False)
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    session.auth = ThreadLocalKerberosAuth(mutual_authentication=OPTIONAL)
+    session.verify = sections['Server']['path_to_cert']
+    session.headers.update(JSON_HEADERS)
+
+    api_base = f"{sections['Server']['server']}/st/console/api/v1.0"
+
+    cfg = Config(
+        server=sections['Server']['server'],
+        api_base=api_base,
+        operations_url=f"{api_base}/operations/",
+        session=session,
+        run_as_credentials=sections['Configuration']['run_as_credentials'],
+        scan_template=sections['Configuration']['scan_template'],
+        deployment_template=sections['Configuration']['deployment_template'],
+        machine_group_server=sections['Configuration']['machine_group_server'],
+        machine_group_database=sections['Configuration']['machine_group_database'],
+        vcenter_server=sections['Server']['vcenter_server'],
+        vcenter_username=sections['Server']['vcenter_username'],
+        vcenter_password=sections['Server']['vcenter_password'],
+    )
+
+    logging.debug("Server FQDN: %s", cfg.server)
+    logging.info("Config loaded")
 
-    # Get the server variable from the [Server] section
-    server = config.get('Server', 'server')
-    vcenter_username = config.get('Server', 'vcenter_username')
-    vcenter_password = config.get('Server', 'vcenter_password')
-    vcenter_username = config.get('Server', 'vcenter_username')
+    _config_cache = (key, cfg)
+    return cfg
 
-    auth = HTTPKerberosAuth(mutual_authentication=OPTIONAL)
-    verify = config.get('Server', 'path_to_cert')
     
-    run_as_credentials = config.get('Configuration', 'run_as_credentials')
-    scan_template = config.get('Configuration', 'scan_template')
-    deployment_template = config.get('Configuration', 'deployment_template')
-    machine_group_server = config.get('Configuration', 'machine_group_server')
-    machine_group_database = config.get('Configuration', 'machine_group_database')
+class BufferedFileHandler(logging.FileHandler):
+    """
+    This class is a file handler that writes through a 64 KiB buffer. Instead of flushing after every
+    record, the buffer is flushed at most once per `flush_interval` seconds, when it is forced by the
+    `IdleFlushQueueListener` and when the handler is closed.
+    """
+    buffer_size = 65536
+    flush_interval = 1.0
 
-    logpath = config.get('Logging', 'logpath')
-    loglevel = config.get('Logging', 'loglevel')
+    def __init__(self, filename, mode='a', encoding=None, delay=False, errors=None):
+        self._last_flush = time.monotonic()
+        super().__init__(filename, mode, encoding, delay, errors)
 
-    init_logging(logpath, loglevel)
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding, errors=self.errors)
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if force or now - self._last_flush >= self.flush_interval:
+            self._last_flush = now
+            super().flush()
+
+
+class IdleFlushQueueListener(logging.handlers.QueueListener):
+    """
+    This class is a queue listener that forces its buffered handlers to flush whenever the queue runs
+    empty. Records written during a burst stay in the buffer, but they reach the log file as soon as
+    the script goes quiet, e.g. while it sleeps between two polls.
+    """
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                if isinstance(handler, BufferedFileHandler):
+                    handler.flush(force=True)
+        return super().dequeue(block)
 
-    logging.debug(f"Server FQDN: {server}")
-    logging.info("Config loaded")
 
-    
 def init_logging(logpath, loglevel):
     """
     This function initializes logging with a specified log path and log level.
     
     :param logpath: The path where the log file will be saved
     :param loglevel: The desired logging level, which can be one of the following strings: "DEBUG",
-    "INFO", "WARNING", "ERROR", or "CRITICAL"
+    "INFO", "WARNING", "ERROR", or "CRITICAL", or a numeric level such as "10"
     """
-    if loglevel == "DEBUG":
-        loglevel = logging.DEBUG
-    if loglevel == "INFO":
+    # Registered level names and numeric levels are accepted, anything else falls back to INFO
+    loglevel = loglevel.strip()
+    loglevel = int(loglevel) if loglevel.isdigit() else logging.getLevelName(loglevel.upper())
+    if not isinstance(loglevel, int):
         loglevel = logging.INFO
-    if loglevel == "WARNING":
-        loglevel = logging.WARNING
-    if loglevel == "ERROR":
-        loglevel = logging.ERROR
-    if loglevel == "CRITICAL":
-        loglevel = logging.CRITICAL
-
-    if not os.path.exists(logpath):
-        os.makedirs(logpath, exist_ok=True)
-    current_time = datetime.datetime.now()
-    logfile = os.path.join(logpath, f'orchestration-{current_time.year}-{current_time.month}-{current_time.day}-{current_time.hour}-{current_time.minute}-{current_time.second}.log')
-    logfile = os.path.expandvars(logfile)
-
-    logging.basicConfig(filename=logfile, level=loglevel, format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S')
+
+    logpath = os.path.expandvars(logpath)
+    os.makedirs(logpath, exist_ok=True)
+    logfile = os.path.join(logpath, datetime.datetime.now().strftime('orchestration-%Y-%m-%d-%H-%M-%S.log'))
+
+    # The file handler runs on a background thread behind a queue, so logging never blocks on disk I/O
+    log_queue = queue.Queue(-1)
+    file_handler = BufferedFileHandler(logfile)
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S'))
+    listener = IdleFlushQueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(loglevel)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
     logging.info("Logging started")
 
-def log(response):
+def log(response, body=True):
     """
     This function logs information about a HTTP request and its response.
     
     :param response: The response object returned by a HTTP request. It contains information such as the
     status code, headers, and response body
+    :param body: Whether the response body should be logged at DEBUG level. This has to be False for
+    streamed responses whose body is still going to be consumed, defaults to True (optional)
+    """
+    root = logging.getLogger()
+    if not root.isEnabledFor(logging.INFO):
+        return
+    logging.info("Requested URL: %s", response.request.url)
+    logging.info("Requested methode: %s", response.request.method)
+    request_body = response.request.body
+    # orjson serializes to bytes, the body is decoded so the log shows the same JSON text either way
+    if isinstance(request_body, bytes):
+        request_body = request_body.decode(errors="replace")
+    logging.info("Request Body: %s", request_body)
+    logging.info("Final response code: %s", response.status_code)
+    if body and root.isEnabledFor(logging.DEBUG):
+        logging.debug("Response: %s", response.text)
+
+
+def _loads(response):
+    """
+    This function decodes the JSON body of a response.
+    
+    :param response: The response object returned by a HTTP request
+    :return: the decoded JSON body.
     """
-    logging.info(f"Requested URL: {response.request.url}")
-    logging.info(f"Requested methode: {response.request.method}")
-    logging.info(f"Request Body: {response.request.body}")
-    logging.info(f"Final response code: {response.status_code}")
-    logging.debug(f"Response: {response.text}")
+    return _json.loads(response.content)
 
 
-def create_session():
+def _iter_items(response):
+    """
+    This function yields the items of the "value" list of a listing response. If ijson is installed,
+    the items are decoded one by one while the body is downloaded instead of decoding the whole body
+    first. In that case the response has to be requested with `stream=True` and must not have been
+    read yet.
+    
+    :param response: The response object returned by a HTTP request for a listing
+    :return: an iterator over the decoded items.
+    """
+    if ijson is not None:
+        response.raw.decode_content = True
+        return ijson.items(response.raw, "value.item")
+    return iter(_loads(response)["value"])
+
+
+def create_session(cfg):
     """
     This function creates a session by sending a POST request to a server with authentication and
     logging information.
     """
-    url = f"{server}/st/console/api/v1.0/sessioncredentials"
+    url = f"{cfg.api_base}/sessioncredentials"
 
     data = {
     "clearText": "Pa$$w0rd",
     "protectionMode": "None"
     }
 
-    payload = json.dumps(data)
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    response = requests.request(
-        "POST", url, auth=auth, headers=headers, data=payload, verify=verify)
+    response = cfg.session.post(url, data=_json.dumps(data), timeout=HTTP_TIMEOUT)
     
     logging.info("Creating a Session")
     log(response)
 
-def delete_session():
+def delete_session(cfg):
     """
     This function sends a DELETE request to a specified URL to remove a session using provided
     authentication credentials and logs the response.
     """
-    url = f"{server}/st/console/api/v1.0/sessioncredentials"
+    url = f"{cfg.api_base}/sessioncredentials"
 
-    response = requests.request(
-        "DELETE", url, auth=auth, verify=verify)
+    response = cfg.session.delete(url, timeout=HTTP_TIMEOUT)
 
     logging.info("Removing the Session")
     log(response)
 
 
-def get_id_by_name(api_endpoint, name):
+@functools.lru_cache(maxsize=None)
+def get_name_index(cfg, url):
+    """
+    This function retrieves a listing from the API and indexes it by name. The result is cached, so
+    looking up several names in the same listing only costs one HTTP request. If ijson is installed,
+    the listing is streamed and only the name and id of every item are kept.
+    
+    :param cfg: The `Config` holding the settings loaded from the config file
+    :param url: The URL of the listing
+    :return: a dictionary mapping the name of every item in the listing to its id.
+    """
+    with cfg.session.get(url, stream=ijson is not None, timeout=HTTP_TIMEOUT) as response:
+        logging.info("Getting the listing %s", url)
+        log(response, body=ijson is None)
+        return {item["name"]: item["id"] for item in _iter_items(response)}
+
+def get_id_by_name(cfg, api_endpoint, name):
     """
     This function retrieves the ID of an item by its name from a specified API endpoint.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param api_endpoint: The API endpoint is a string that specifies the endpoint of the API that we
     want to access. It could be something like "users", "products", "orders", etc
     :param name: The name of the item you want to get the ID for
@@ -157,38 +333,36 @@ def get_id_by_name(api_endpoint, name):
     endpoint.
     """
     if api_endpoint == 'machinegroups':
-        url = f"{server}/st/console/api/v1.0/{api_endpoint}/?count=1000"
+        url = f"{cfg.api_base}/{api_endpoint}/?count=1000"
     elif api_endpoint == 'credentials':
-        url = f"{server}/st/console/api/v1.0/{api_endpoint}/?name={name}"
+        url = f"{cfg.api_base}/{api_endpoint}/?name={urllib.parse.quote(name)}"
     else:
-        url = f"{server}/st/console/api/v1.0/{api_endpoint}"
+        url = f"{cfg.api_base}/{api_endpoint}"
 
-    response = requests.get(url, auth=auth, verify=verify)
+    logging.info("Getting the %s id for the %s %s", api_endpoint, name, api_endpoint)
 
-    logging.info(f"Getting the {api_endpoint} id for the {name} {api_endpoint}")
-    log(response)
-
-    py_obj = response.json()
-    for item in py_obj["value"]:
-        if item["name"] == name:
-            return item["id"]
+    return get_name_index(cfg, url).get(name)
             
-def get_run_as_credentials_id(run_as_credentials_name):
-    return get_id_by_name("credentials", run_as_credentials_name)
+def get_run_as_credentials_id(cfg, run_as_credentials_name):
+    return get_id_by_name(cfg, "credentials", run_as_credentials_name)
     
-def get_scan_template_id(scan_template_name):
-    return get_id_by_name("patch/scanTemplates", scan_template_name)
+def get_scan_template_id(cfg, scan_template_name):
+    return get_id_by_name(cfg, "patch/scanTemplates", scan_template_name)
+
+def get_deployment_template_id(cfg, deployment_template_name):
+    return get_id_by_name(cfg, "patch/deploytemplates", deployment_template_name)
 
-def get_deployment_template_id(deployment_template_name):
-    return get_id_by_name("patch/deploytemplates", deployment_template_name)
+def get_machine_group_id(cfg, machine_group_name):
+    return get_id_by_name(cfg, "machinegroups", machine_group_name)
 
-def get_machine_group_id(machine_group_name):
-    return get_id_by_name("machinegroups", machine_group_name)
+def get_machine_group_ids(cfg, *machine_group_names):
+    return [get_machine_group_id(cfg, machine_group_name) for machine_group_name in machine_group_names]
 
-def scan_machine_group(machine_group_id, scan_template_id, credential_id):
+def scan_machine_group(cfg, machine_group_id, scan_template_id, credential_id):
     """
     The function initiates a machine group scan using a specified scan template and credential ID.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param machine_group_id: The ID of the machine group that needs to be scanned
     :param scan_template_id: The ID of the scan template that will be used for the scan
     :param credential_id: The ID of the credential that will be used to run the scan on the machines in
@@ -203,42 +377,117 @@ def scan_machine_group(machine_group_id, scan_template_id, credential_id):
         "runAsCredentialId": credential_id
     }
 
-    url = f"{server}/st/console/api/v1.0/patch/scans"
+    url = f"{cfg.api_base}/patch/scans"
 
-    payload = json.dumps(data)
-    headers = {
-        'Content-Type': 'application/json'
-    }
-
-    response = requests.request(
-        "POST", url, auth=auth, headers=headers, data=payload, verify=verify)
+    response = cfg.session.post(url, data=_json.dumps(data), timeout=HTTP_TIMEOUT)
     
-    logging.info(f"Starting the Machine Group Scan on Machine Group ID {machine_group_id}")
+    logging.info("Starting the Machine Group Scan on Machine Group ID %s", machine_group_id)
     log(response)
-    return response.json()["id"]
+    return _loads(response)["id"]
 
-def operation_status(id):
+def operation_status(cfg, id, etag=None):
     """
     This function retrieves the status of a process operation with a given ID from a server API.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param id: The id parameter is the unique identifier of the process for which we want to retrieve
     the operation status
+    :param etag: The ETag of a previously retrieved status. If it is given, the request is made
+    conditional and the server may answer with 304 Not Modified, defaults to None (optional)
     :return: the response object obtained from making a GET request to a specific URL. The response
     object contains information about the status of an operation with a given ID.
     """
-    url = f"{server}/st/console/api/v1.0/operations/{id}"
+    url = cfg.operations_url + str(id)
 
-    response = requests.get(url, auth=auth, verify=verify)
+    headers = {'If-None-Match': etag} if etag else None
+    response = cfg.session.get(url, headers=headers, timeout=HTTP_TIMEOUT)
 
-    logging.info(f"Getting the operation status for the process with the id {id}")
+    logging.info("Getting the operation status for the process with the id %s", id)
     log(response)
 
     return response
 
-def patch_deployment(machine_group_server_scan_id, deployment_template_id):
+async def poll_operation(cfg, op_id, key="status", initial=1.0, cap=60.0, factor=2.0, timeout=3600.0):
+    """
+    This asynchronous generator polls the status of an operation and yields every decoded status. The
+    interval between two polls grows exponentially up to a maximum and is jittered by +/- 20 percent.
+    It starts over at the initial interval whenever the watched field changes. Polls after the first one
+    are conditional on the ETag of the last status, so an unchanged status costs only a 304 response.
+    The caller stops the polling by leaving the loop.
+    
+    :param cfg: The `Config` holding the settings loaded from the config file
+    :param op_id: The ID of the operation that should be polled
+    :param key: The field of the operation status whose changes reset the interval, defaults to
+    "status" (optional)
+    :param initial: The first interval in seconds, defaults to 1.0 (optional)
+    :param cap: The maximum interval in seconds, defaults to 60.0 (optional)
+    :param factor: The factor the interval grows by after every poll, defaults to 2.0 (optional)
+    :param timeout: The number of seconds after which the polling gives up, defaults to 3600.0
+    (optional)
+    :raises TimeoutError: if the caller did not stop the polling within `timeout` seconds.
+    :raises RuntimeError: if the operation ended in one of the `FAILED_STATUSES`.
+    """
+    # Every request is bounded by `HTTP_TIMEOUT`, so a stalled request cannot hold the loop past the
+    # deadline. Timeouts and connection errors are retried like an unanswered poll.
+    op_status = functools.partial(operation_status, cfg)
+    deadline = time.monotonic() + timeout
+    delay = initial
+    data = None
+    etag = None
+    while True:
+        previous = data.get(key) if data is not None else None
+        try:
+            response = await asyncio.to_thread(op_status, op_id, etag)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            # A stalled or dropped request counts as a failed poll, the deadline below still applies
+            logging.warning("Getting the status of the operation %s failed", op_id, exc_info=True)
+            response = None
+        if response is not None and response.status_code == 200:
+            data = _loads(response)
+            etag = response.headers.get("ETag")
+        # On 304 Not Modified the previously decoded status is still current
+        if response is not None and response.status_code in (200, 304) and data is not None:
+            if data.get("status") in FAILED_STATUSES:
+                raise RuntimeError(f"Operation {op_id} ended with status {data.get('status')}")
+            if previous is not None and data.get(key) != previous:
+                # The operation just moved on, so the next change is likely to follow soon
+                logging.info("The %s of the operation changed to %s", key, data.get(key))
+                delay = initial
+            yield data
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Operation {op_id} was still being polled after {timeout} seconds")
+        # The time the request took already counts towards the interval
+        elapsed = response.elapsed.total_seconds() if response is not None else 0.0
+        wait = max(0.0, min(delay * random.uniform(0.8, 1.2), remaining) - elapsed)
+        logging.info("Waiting %.1f seconds until continuing to check if the operation finished", wait)
+        await asyncio.sleep(wait)
+        delay = min(cap, delay * factor)
+
+async def poll_until(cfg, op_id, desired_status, key="status", **kwargs):
+    """
+    This coroutine polls the status of an operation until a field of it reaches a desired value.
+    
+    :param cfg: The `Config` holding the settings loaded from the config file
+    :param op_id: The ID of the operation that should be polled
+    :param desired_status: The value of the field that ends the polling
+    :param key: The field of the operation status that is compared with `desired_status`, defaults to
+    "status" (optional)
+    :param kwargs: The interval and timeout settings that are passed on to `poll_operation()`
+    :return: the decoded operation status in which the field reached the desired value.
+    :raises TimeoutError: if the field did not reach the desired value in time.
+    :raises RuntimeError: if the operation ended in one of the `FAILED_STATUSES`.
+    """
+    async with contextlib.aclosing(poll_operation(cfg, op_id, key, **kwargs)) as statuses:
+        async for data in statuses:
+            if data.get(key) == desired_status:
+                return data
+
+def patch_deployment(cfg, machine_group_server_scan_id, deployment_template_id):
     """
     This function deploys a patch to a machine group server scan using a deployment template ID.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param machine_group_server_scan_id: The ID of the server scan that the patch deployment will be
     based on
     :param deployment_template_id: The ID of the deployment template that will be used for the patch
@@ -251,25 +500,21 @@ def patch_deployment(machine_group_server_scan_id, deployment_template_id):
         "templateId": deployment_template_id
     }
 
-    url = f"{server}/st/console/api/v1.0/patch/deployments"
-
-    payload = json.dumps(data)
-    headers = {
-        'Content-Type': 'application/json'
-    }
+    url = f"{cfg.api_base}/patch/deployments"
 
-    response = requests.request(
-        "POST", url, auth=auth, headers=headers, data=payload, verify=verify)
+    response = cfg.session.post(url, data=_json.dumps(data), timeout=HTTP_TIMEOUT)
     
-    logging.info(f"Starting the deployment for scan iud {machine_group_server_scan_id}")
+    logging.info("Starting the deployment for scan iud %s", machine_group_server_scan_id)
     log(response)
     uuid = response.headers["Location"].split("/")[-1] 
     return uuid
 
-def start_deployment(machine_group_server_scan_id, deployment_template_id):
+async def start_deployment(cfg, machine_group_server_scan_id, deployment_template_id):
     """
-    This function waits for a server scan to succeed before starting a patch deployment.
+    This coroutine waits for a server scan to succeed before starting a patch deployment. The blocking
+    HTTP calls are run in a worker thread so that other rings can be orchestrated at the same time.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param machine_group_server_scan_id: This parameter is likely an ID or identifier for a machine
     group server scan. It is used in the function to check the status of the scan and wait until it
     reaches a desired status before continuing with the patch deployment
@@ -278,161 +523,270 @@ def start_deployment(machine_group_server_scan_id, deployment_template_id):
     :return: the result of the `patch_deployment` function with the `machine_group_server_scan_id` and
     `deployment_template_id` as arguments.
     """
-    logging.info(f"Waiting for the scan to succeed and beeing able to start the patch deployment")
+    logging.info("Waiting for the scan to succeed and beeing able to start the patch deployment")
     
-    desired_status = "Succeeded"
-
-    while True:
-        response = operation_status(machine_group_server_scan_id)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("status") == desired_status:
-                logging.info(f"Status switched to succeeded")
-                break  # Exit the loop if the desired status is found
-        time.sleep(30)
-        logging.info(f"Waiting 30 seconds until continuing to check if the operation finished")
+    await poll_until(cfg, machine_group_server_scan_id, "Succeeded")
+    logging.info("Status switched to succeeded")
     
-    return patch_deployment(machine_group_server_scan_id, deployment_template_id)
+    return await asyncio.to_thread(patch_deployment, cfg, machine_group_server_scan_id, deployment_template_id)
 
-def get_patch_deployment_machines(id):
+def list_deployment_machines(cfg, id):
     """
-    This function retrieves the machines associated with a patch deployment using the deployment ID.
+    This function lists the machines of a patch deployment. Like the other listings, the response is
+    streamed if ijson is installed.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param id: The ID of the patch deployment for which we want to retrieve the machines
-    :return: a list of machine addresses for a patch deployment with the given ID.
+    :return: a list of dictionaries with the name and IP address of every machine of the deployment.
     """
+    url = f"{cfg.api_base}/patch/deployments/{id}/machines"
 
-    while True: 
-        status = operation_status(id).json()
-        if status.get("operation") == "PatchDeployment":
-            break
-        time.sleep(5)
-
-    url = f"{server}/st/console/api/v1.0/patch/deployments/{id}/machines"
-
-    response = requests.get(url, auth=auth, verify=verify)
-
-    logging.info(f"Getting the machines for the deployment with the id {id}")
-    log(response)
-    py_obj = response.json()
-    ret = []
-    for item in py_obj['value']:
-        obj = {"machine_name": item["name"], "ip_address": item["address"]}
-        ret.append(obj)
-    return ret
+    with cfg.session.get(url, stream=ijson is not None, timeout=HTTP_TIMEOUT) as response:
+        logging.info("Getting the machines for the deployment with the id %s", id)
+        log(response, body=ijson is None)
+        return [{"machine_name": item["name"], "ip_address": item["address"]} for item in _iter_items(response)]
 
-def shutdown(ip, reboot):
+async def shutdown(ip, reboot):
     """
-    The function performs a shutdown or reboot event on a specified IP address.
+    The coroutine performs a shutdown or reboot event on a specified IP address.
     
     :param ip: The IP address of the computer that needs to be shut down or rebooted
     :param reboot: A boolean value indicating whether the system should be rebooted (True) or shut down
     (False)
-    :return: The result of the `os.system()` command is being returned.
+    :return: The return code of the `shutdown` command, or None if the command could not be started or
+    timed out.
     """
-    if reboot:
-        command = f"shutdown /r /t 0 /m \\\\{ip}"
-    else:
-        command = f"shutdown /s /t 0 /m \\\\{ip}"
-    result = os.system(command)
+    command = ["shutdown", "/r" if reboot else "/s", "/t", "0", "/m", f"\\\\{ip}"]
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+    except OSError:
+        logging.exception("Shutdown event on IP %s could not be started", ip)
+        return None
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=30)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logging.error("Shutdown event on IP %s timed out", ip)
+        return None
+
+    logging.info("Performing shutdown event on IP %s with reboot = %s", ip, reboot)
+    if process.returncode != 0:
+        logging.error("Shutdown event on IP %s failed with code %s: %s", ip, process.returncode,
+                      stderr.decode(errors="replace").strip())
+
+    return process.returncode
 
-    logging.info(f"Performing shutdown event on IP {ip} with reboot = {reboot}")
+async def shutdown_machines(machines, reboot):
+    """
+    The coroutine performs the shutdown or reboot event on all machines concurrently.
+    
+    :param machines: A list of dictionaries containing the IP address of every machine
+    :param reboot: A boolean value indicating whether the systems should be rebooted (True) or shut
+    down (False)
+    :return: a list with the return code of the `shutdown` command for every machine.
+    """
+    limit = asyncio.Semaphore(MAX_SHUTDOWN_PROCESSES)
+
+    async def limited_shutdown(ip):
+        async with limit:
+            return await shutdown(ip, reboot)
+
+    # The above code bounds the number of concurrent `shutdown` processes, so a large ring does not spawn
+    # one process per machine at once.
+    results = await asyncio.gather(*(limited_shutdown(machine["ip_address"]) for machine in machines))
+
+    failed = [machine["ip_address"] for machine, result in zip(machines, results) if result != 0]
+    if failed:
+        logging.error("Shutdown event failed on %s of %s machines: %s", len(failed), len(machines), ", ".join(failed))
+    else:
+        logging.info("Shutdown event performed on all %s machines", len(machines))
 
-    return result
+    return results
 
-def wait_for_shutdown(deployment_server_machines, deployment_id, reboot_behaivior=False):
+async def wait_for_shutdown(cfg, deployment_id, reboot_behaivior=False, gate=None):
     """
-    This function waits for a patch deployment to finish and then shuts down the deployment server
-    machines.
+    This coroutine waits for a patch deployment to finish and then shuts down the deployment server
+    machines. A single polling loop is used for both: the machines of the deployment are listed as
+    soon as the operation shows up as a patch deployment, and the loop ends once it succeeded.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param deployment_id: The ID of the deployment that is being monitored for completion
     :param reboot_behaivior: A boolean parameter that determines whether the machines should be rebooted
     after the patch deployment is complete. If set to True, the machines will be rebooted. If set to
     False, the machines will not be rebooted, defaults to False (optional)
+    :param gate: An optional `asyncio.Future` that has to be resolved before the shutdown event is
+    performed. This is used to hold back the reboot of one ring until another ring has been shut down.
+    If it resolves to False, the other ring failed and the shutdown event is skipped
+    :raises RuntimeError: if the ring behind `gate` failed.
     """
-    desired_status = "Succeeded"
-
-    while True:
-        response = operation_status(deployment_id)
-        if response.status_code == 200:
-            data = response.json()
-            if data.get("status") == desired_status:
-                logging.info(f"Status switched to succeeded")
+    deployment_machines = None
+    async with contextlib.aclosing(poll_operation(cfg, deployment_id, timeout=4 * 3600.0)) as statuses:
+        async for data in statuses:
+            if deployment_machines is None and data.get("operation") == "PatchDeployment":
+                deployment_machines = await asyncio.to_thread(list_deployment_machines, cfg, deployment_id)
+            if data.get("status") == "Succeeded":
                 break
-        time.sleep(30)
-        logging.info(f"Waiting 30 seconds until continuing to check if the operation finished")
+    logging.info("Status switched to succeeded")
+
+    if deployment_machines is None:
+        deployment_machines = await asyncio.to_thread(list_deployment_machines, cfg, deployment_id)
+
+    if gate is not None:
+        logging.info("Waiting for the previous ring to be shut down before the shutdown event")
+        if not await gate:
+            raise RuntimeError("The previous ring failed, the shutdown event is skipped")
     
-    for machine in deployment_server_machines:
-        shutdown(machine["ip_address"], reboot_behaivior)
+    await shutdown_machines(deployment_machines, reboot_behaivior)
+
+@functools.lru_cache(maxsize=None)
+def vcenter_session(cfg):
+    """
+    This function logs in to the vCenter server and returns a session that sends the vCenter session id
+    with every request. The session is cached, so the login only happens once per run.
+    
+    :param cfg: The `Config` holding the settings loaded from the config file
+    :return: a `requests.Session` authenticated against the vCenter server.
+    """
+    session = requests.Session()
+    session.verify = False
+    session.headers.update(JSON_HEADERS)
+    response = session.post(f'{cfg.vcenter_server}/rest/com/vmware/cis/session',
+                            auth=(cfg.vcenter_username, cfg.vcenter_password), timeout=HTTP_TIMEOUT)
+
+    logging.info("Logging in to the vCenter server, response code %s", response.status_code)
+
+    session.headers['vmware-api-session-id'] = _loads(response)['value']
+    return session
 
 def check_sql_server(ip):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    """
+    This function checks if the SQL server on a machine accepts connections.
+    
+    :param ip: The IP address of the database machine
+    :return: True if a connection could be established within two seconds, otherwise False.
+    """
     try:
-        s.connect((ip, 1434))
-        s.close()
-        return True
-    except:
+        with socket.create_connection((ip, 1434), timeout=2.0):
+            return True
+    except OSError:
         return False
     
-def start_server(server_machines, database_machines):
+def start_server(cfg, server_machines, database_machines):
     """
     The function starts virtual machines on a vCenter server and checks if SQL servers are running on a
     list of database machines.
     
+    :param cfg: The `Config` holding the settings loaded from the config file
     :param server_machines: A list of dictionaries containing information about the server machines to
     be started. Each dictionary contains the machine name and other relevant details
     :param database_machines: A list of dictionaries containing information about the database machines,
     including their IP addresses
     """
-    login_url = f'{vcenter_server}/rest/com/vmware/cis/session'
-    login_data = {'username': vcenter_username, 'password': vcenter_password}
-    headers = {'Content-type': 'application/json'}
-    response = requests.post(login_url, data=json.dumps(login_data), headers=headers, verify=False)
-    session_id = response.json()['value']
-    
-    # The above code is implementing an infinite loop that iterates over a list of database machines.
-    # For each machine, it checks if the SQL server is running by calling the `check_sql_server()`
-    # function. If the server is running, it increments the `count` variable. The loop continues until
-    # all the machines in the list have been checked and the `count` variable is equal to the length
-    # of the list. The loop sleeps for 15 seconds between iterations.
-    while True:
-        for server in database_machines:
-            count = 0
-            if check_sql_server(server["ip_address"]):
-                count += 1
-        if count == database_machines.len():
-            break
-        time.sleep(15)
+    # The above code waits until the SQL server is running on all database machines. All machines that
+    # are still down are probed in parallel, machines that are up are removed from the `pending` set
+    # so they are not probed again. The loop sleeps for 15 seconds between iterations.
+    pending = {machine["ip_address"] for machine in database_machines}
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        while True:
+            addresses = list(pending)
+            pending -= {ip for ip, running in zip(addresses, executor.map(check_sql_server, addresses)) if running}
+            if not pending:
+                break
+            time.sleep(15)
 
     # The above code is using the VMware vSphere REST API to start virtual machines on a vCenter
-    # server. It loops through a list of server machines, gets the ID of the virtual machine
-    # associated with each server machine, and then sends a POST request to start the virtual machine.
-    for item in server_machines:
-        vm_url = f'{vcenter_server}/rest/vcenter/vm'
-        vm_data = {'filter.names': item["machine_name"]}
-        headers = {'Content-type': 'application/json', 'vmware-api-session-id': session_id}
-        response = requests.get(vm_url, params=vm_data, headers=headers)
-        vm_id = response.json()['value'][0]['vm']
-        # Start the virtual machine
-        power_url = f'{vcenter_server}/rest/vcenter/vm/{vm_id}/power/start'
-        power_data = {'spec': {}}
-        headers = {'Content-type': 'application/json', 'vmware-api-session-id': session_id}
-        response = requests.post(power_url, data=json.dumps(power_data), headers=headers)
+    # server. It gets the IDs of all server machines with a single request and then sends the POST
+    # requests to start the virtual machines in parallel.
+    names = [item["machine_name"] for item in server_machines]
+    if not names:
+        # Without any filter the vCenter would return every virtual machine
+        return
+    vcs = vcenter_session(cfg)
+    response = vcs.get(f'{cfg.vcenter_server}/rest/vcenter/vm', params=[('filter.names', name) for name in names],
+                       timeout=HTTP_TIMEOUT)
+    id_by_name = {vm['name']: vm['vm'] for vm in _loads(response)['value']}
+    for name in set(names) - id_by_name.keys():
+        logging.warning("No virtual machine named %s found on the vCenter server", name)
+    # The power-on body is the same for every virtual machine, so it is serialized only once
+    power_data = _json.dumps({'spec': {}})
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda vm_id: vcs.post(f'{cfg.vcenter_server}/rest/vcenter/vm/{vm_id}/power/start', data=power_data,
+                                                    timeout=HTTP_TIMEOUT),
+                          id_by_name.values()))
+
+
+async def run_ring(cfg, machine_group_id, scan_template_id, credential_id, deployment_template_id, reboot_behaivior=False, gate=None, done=None):
+    """
+    This coroutine runs the whole pipeline for one ring: scanning the machine group, deploying the
+    patches and shutting down the machines once the deployment succeeded.
+    
+    :param cfg: The `Config` holding the settings loaded from the config file
+    :param machine_group_id: The ID of the machine group that makes up the ring
+    :param scan_template_id: The ID of the scan template that will be used for the scan
+    :param credential_id: The ID of the credential that will be used to run the scan
+    :param deployment_template_id: The ID of the deployment template that will be used for the patch
+    deployment
+    :param reboot_behaivior: Whether the machines should be rebooted (True) or shut down (False) after
+    the deployment, defaults to False (optional)
+    :param gate: An optional `asyncio.Future` that has to be resolved before this ring is shut down. The
+    ring is only shut down if its result is True
+    :param done: An optional `asyncio.Future` that is resolved with the success of this ring once it has
+    been shut down or has failed
+    :return: True if the ring has been patched and shut down, False if it failed.
+    """
+    # A failing ring is logged and reported through `done`, it must not cancel the other ring
+    try:
+        scan_id = await asyncio.to_thread(scan_machine_group, cfg, machine_group_id, scan_template_id, credential_id)
+        deployment_id = await start_deployment(cfg, scan_id, deployment_template_id)
+        await wait_for_shutdown(cfg, deployment_id, reboot_behaivior, gate)
+    except Exception:
+        logging.exception("The ring of the machine group with the id %s failed", machine_group_id)
+        success = False
+    else:
+        success = True
+
+    if done is not None:
+        done.set_result(success)
+    return success
+
+async def orchestrate(cfg):
+    """
+    This coroutine looks up the required IDs and runs the server ring and the database ring
+    concurrently. Only the reboot of the database ring is held back until the server ring has been
+    shut down, everything else (scans, deployments and polling) overlaps. A failure of one ring does
+    not cancel the other one, but the database ring is not rebooted if the server ring failed.
+    
+    :param cfg: The `Config` holding the settings loaded from the config file
+    :raises RuntimeError: if at least one ring failed.
+    """
+    # All blocking calls run on this pool. It stays below the connection pool size of the session, so
+    # every worker thread can keep its own connection to the server. The session is shared by the
+    # threads: its connection pool is thread-safe, and the Kerberos auth keeps one security context
+    # per thread (see `ThreadLocalKerberosAuth`), so concurrent negotiations cannot mix up contexts.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=8))
+
+    #create_session(cfg)
+    # The lookups are independent of each other, so they run in parallel worker threads. Both machine
+    # groups are looked up in the same thread, so the second lookup hits the cached listing.
+    credential_id, scan_template_id, deployment_template_id, (machine_group_server_id, machine_group_database_id) = await asyncio.gather(
+        asyncio.to_thread(get_run_as_credentials_id, cfg, cfg.run_as_credentials),
+        asyncio.to_thread(get_scan_template_id, cfg, cfg.scan_template),
+        asyncio.to_thread(get_deployment_template_id, cfg, cfg.deployment_template),
+        asyncio.to_thread(get_machine_group_ids, cfg, cfg.machine_group_server, cfg.machine_group_database),
+    )
+
+    server_ring_down = asyncio.get_running_loop().create_future()
+    results = await asyncio.gather(
+        run_ring(cfg, machine_group_server_id, scan_template_id, credential_id, deployment_template_id,
+                 done=server_ring_down),
+        run_ring(cfg, machine_group_database_id, scan_template_id, credential_id, deployment_template_id,
+                 reboot_behaivior=True, gate=server_ring_down),
+    )
+    if not all(results):
+        raise RuntimeError("At least one ring failed, see the log file for details")
 
 
 if __name__ == '__main__':
-    load_config()
-    #create_session()
-    credential_id = get_run_as_credentials_id(run_as_credentials)
-    scan_template_id = get_scan_template_id(scan_template)
-    machine_group_server_id = get_machine_group_id(machine_group_server)
-    machine_group_database_id = get_machine_group_id(machine_group_database)
-    deployment_template_id = get_deployment_template_id(deployment_template)
-    machine_group_server_scan_id = scan_machine_group(machine_group_server_id, scan_template_id, credential_id)
-    deployment_server_id = start_deployment(machine_group_server_scan_id, deployment_template_id)
-    deployment_server_machines = get_patch_deployment_machines(deployment_server_id)
-    wait_for_shutdown(deployment_server_machines, deployment_server_id)
-    machine_group_database_scan_id = scan_machine_group(machine_group_database_id, scan_template_id, credential_id)
-    deployment_database_id = start_deployment(machine_group_database_scan_id, deployment_template_id)
-    deployment_database_machines = get_patch_deployment_machines(deployment_database_id)
-    wait_for_shutdown(deployment_database_machines, deployment_database_id, True)
\ No newline at end of file
+    asyncio.run(orchestrate(load_config()))